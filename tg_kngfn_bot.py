@@ -1,13 +1,15 @@
 import os
+import re
 import asyncio
 import logging
 import random
 import io
-import csv
+import contextlib
+from collections import OrderedDict
 
 from aiohttp import web
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import asyncpg
+import orjson
 
 from telegram import Update, InputFile
 from telegram.ext import (
@@ -36,87 +38,229 @@ if not DATABASE_URL:
 
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 
-lock = asyncio.Lock()
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
 
+ADD_PARTICIPANTS_SQL = """
+    INSERT INTO participants (email)
+    SELECT unnest($1::text[])
+    ON CONFLICT (email) DO NOTHING
+    RETURNING code, email;
+"""
 
-def get_conn():
-    return psycopg2.connect(DATABASE_URL)
+# окно и максимальный размер пачки для группировки регистраций
+BATCH_WINDOW = 0.02
+BATCH_MAX_SIZE = 100
 
+# сколько апдейтов обрабатываем одновременно; не меньше размера пачки,
+# иначе пачки регистраций не наберутся. Сверх этого вебхук не отвечает
+# Telegram, пока не освободится слот
+MAX_CONCURRENT_UPDATES = BATCH_MAX_SIZE
 
-def init_db():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS participants (
-            id SERIAL PRIMARY KEY,
-            email TEXT UNIQUE NOT NULL
-        );
-        """
+EMAIL_CACHE_SIZE = 10_000
+
+# сколько раз пробуем угадать существующий id до полного перебора
+WINNER_PICK_ATTEMPTS = 8
+
+# части домена не пересекаются с точками, поэтому regex не откатывается
+EMAIL_RE = re.compile(r"[^@\s]+@[^@\s.]+(?:\.[^@\s.]+)+")
+EMAIL_MAX_LEN = 254
+
+pool: asyncpg.Pool | None = None
+
+# очередь (email, future) на вставку, разбирается _insert_worker; каждый
+# обработчик кладёт одну запись, так что размер ограничен числом апдейтов,
+# обрабатываемых одновременно
+_insert_queue: asyncio.Queue[tuple[str, asyncio.Future]] = asyncio.Queue()
+
+# email -> USERXXX для уже зарегистрированных, с вытеснением по LRU
+_email_cache: OrderedDict[str, str] = OrderedDict()
+
+
+def _cache_email(email: str, code: str):
+    _email_cache[email] = code
+    _email_cache.move_to_end(email)
+    if len(_email_cache) > EMAIL_CACHE_SIZE:
+        _email_cache.popitem(last=False)
+
+
+def cached_code(email: str) -> str | None:
+    """Вернуть ID участника из кэша или None, если email там нет."""
+    code = _email_cache.get(email)
+    if code is not None:
+        _email_cache.move_to_end(email)
+    return code
+
+
+async def init_db():
+    """Создать пул соединений и таблицу, если её нет."""
+    global pool
+    pool = await asyncpg.create_pool(
+        DATABASE_URL, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX
     )
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with pool.acquire() as conn:
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS participants (
+                id SERIAL PRIMARY KEY,
+                email TEXT UNIQUE NOT NULL
+            );
+            """
+        )
+        # ID вида USERXXX считает сама база; lpad обрезает длинные
+        # строки, поэтому id от 1000 берём как есть
+        await conn.execute(
+            """
+            ALTER TABLE participants
+            ADD COLUMN IF NOT EXISTS code TEXT GENERATED ALWAYS AS (
+                'USER' || CASE
+                    WHEN id < 1000 THEN lpad(id::text, 3, '0')
+                    ELSE id::text
+                END
+            ) STORED;
+            CREATE UNIQUE INDEX IF NOT EXISTS participants_code_idx
+                ON participants (code);
+            """
+        )
+        # прогреваем кэш последними зарегистрированными участниками
+        rows = await conn.fetch(
+            "SELECT code, email FROM participants ORDER BY id DESC LIMIT $1;",
+            EMAIL_CACHE_SIZE,
+        )
+    for row in reversed(rows):
+        _cache_email(row["email"], row["code"])
+
+
+async def _insert_emails(emails: list[str]) -> dict[str, str]:
+    """Вставить email пачкой и вернуть email -> USERXXX для новых."""
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(ADD_PARTICIPANTS_SQL, emails)
+    return {row["email"]: row["code"] for row in rows}
+
+
+# ошибки в данных конкретной строки: только их имеет смысл повторять
+# поштучно, остальные (сеть, пул) валят всю пачку сразу
+_ROW_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError)
+
+
+def _fail_futures(futs, exc: BaseException):
+    for fut in futs:
+        if not fut.done():
+            fut.set_exception(exc)
+
+
+async def _insert_batch(batch: list[tuple[str, asyncio.Future]]):
+    """Вставить пачку email и раздать ID ожидающим."""
+    waiters: dict[str, list[asyncio.Future]] = {}
+    for email, fut in batch:
+        waiters.setdefault(email, []).append(fut)
 
+    try:
+        codes = await _insert_emails(list(waiters))
+    except _ROW_ERRORS:
+        logger.exception("Failed to insert participants batch, retrying one by one")
+        codes = None
+    except Exception as exc:
+        logger.exception("Failed to insert participants batch")
+        _fail_futures((fut for _, fut in batch), exc)
+        return
 
-async def add_participant(email: str) -> str | None:
-    """Добавить участника, вернуть его ID вида USERXXX или None, если уже есть."""
-    def _inner():
-        conn = get_conn()
-        cur = conn.cursor()
+    for email, futs in waiters.items():
+        if codes is None:
+            # одна плохая строка не должна ронять всю пачку
+            try:
+                code = (await _insert_emails([email])).get(email)
+            except _ROW_ERRORS as exc:
+                logger.exception("Failed to insert participant")
+                _fail_futures(futs, exc)
+                continue
+            except Exception as exc:
+                logger.exception("Failed to insert participant")
+                _fail_futures((fut for _, fut in batch), exc)
+                return
+        else:
+            code = codes.get(email)
+        # повтор того же email в пачке считается уже зарегистрированным
+        for i, fut in enumerate(futs):
+            if not fut.done():
+                fut.set_result(code if i == 0 else None)
+
+
+async def _insert_worker():
+    """Собирать email из очереди в пачки и вставлять их."""
+    while True:
+        batch = [await _insert_queue.get()]
         try:
-            cur.execute(
-                """
-                INSERT INTO participants (email)
-                VALUES (%s)
-                ON CONFLICT (email) DO NOTHING
-                RETURNING id;
-                """,
-                (email,),
+            await asyncio.sleep(BATCH_WINDOW)
+            while len(batch) < BATCH_MAX_SIZE and not _insert_queue.empty():
+                batch.append(_insert_queue.get_nowait())
+            await _insert_batch(batch)
+        except asyncio.CancelledError:
+            _fail_futures(
+                (fut for _, fut in batch), RuntimeError("Service is shutting down")
             )
-            row = cur.fetchone()
-            conn.commit()
-        finally:
-            cur.close()
-            conn.close()
-        return row[0] if row else None
-
-    new_id = await asyncio.to_thread(_inner)
-    if new_id is None:
-        return None
-    return f"USER{new_id:03}"
+            raise
 
 
-async def pick_random_winner() -> str | None:
-    """Вернуть ID победителя (USERXXX) или None, если никого нет."""
-    def _inner():
-        conn = get_conn()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT id FROM participants;")
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        return rows
-
-    rows = await asyncio.to_thread(_inner)
-    if not rows:
-        return None
-    winner_row = random.choice(rows)
-    return f"USER{winner_row['id']:03}"
+def _fail_pending_inserts(exc: BaseException):
+    """Завершить ошибкой всех, кто ещё ждёт в очереди на вставку."""
+    while not _insert_queue.empty():
+        _, fut = _insert_queue.get_nowait()
+        if not fut.done():
+            fut.set_exception(exc)
+
 
+async def add_participant(email: str) -> str | None:
+    """Добавить участника, вернуть его ID вида USERXXX или None, если уже есть."""
+    fut = asyncio.get_running_loop().create_future()
+    await _insert_queue.put((email, fut))
+    code = await fut
+    if code is not None:
+        _cache_email(email, code)
+    return code
 
-async def fetch_all_participants():
-    """Вернуть список (id, email) всех участников."""
-    def _inner():
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT id, email FROM participants ORDER BY id;")
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        return rows
 
-    return await asyncio.to_thread(_inner)
+async def pick_random_winner() -> str | None:
+    """Вернуть ID победителя (USERXXX) или None, если никого нет."""
+    async with pool.acquire() as conn:
+        bounds = await conn.fetchrow(
+            "SELECT min(id) AS lo, max(id) AS hi FROM participants;"
+        )
+        if bounds["lo"] is None:
+            return None
+        # случайный id из диапазона по индексу; в id бывают дыры
+        # (ON CONFLICT тратит значения sequence), поэтому промахи
+        # отбрасываем, а после нескольких неудач выбираем перебором
+        for _ in range(WINNER_PICK_ATTEMPTS):
+            winner_code = await conn.fetchval(
+                "SELECT code FROM participants WHERE id = $1;",
+                random.randint(bounds["lo"], bounds["hi"]),
+            )
+            if winner_code is not None:
+                return winner_code
+        return await conn.fetchval(
+            "SELECT code FROM participants ORDER BY random() LIMIT 1;"
+        )
+
+
+async def export_participants_csv() -> io.BytesIO | None:
+    """Вернуть CSV (id, email) всех участников или None, если никого нет."""
+    buf = io.BytesIO()
+
+    async def _write(chunk: bytes):
+        buf.write(chunk)
+
+    async with pool.acquire() as conn:
+        status = await conn.copy_from_query(
+            "SELECT id, email FROM participants ORDER BY id",
+            output=_write,
+            format="csv",
+            header=True,
+        )
+    if status == "COPY 0":
+        return None
+    buf.seek(0)
+    return buf
 
 
 # ---------- handlers ----------
@@ -130,12 +274,15 @@ async def handle_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     text = update.message.text.strip()
 
-    if "@" not in text or "." not in text:
+    if len(text) > EMAIL_MAX_LEN or not EMAIL_RE.fullmatch(text):
         await update.message.reply_text("Похоже, это не email. Попробуй ещё раз.")
         return
 
-    async with lock:
-        user_code = await add_participant(text)
+    if cached_code(text) is not None:
+        await update.message.reply_text("Этот email уже зарегистрирован.")
+        return
+
+    user_code = await add_participant(text)
 
     if user_code is None:
         await update.message.reply_text("Этот email уже зарегистрирован.")
@@ -154,8 +301,7 @@ async def raffle(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Команда недоступна.")
         return
 
-    async with lock:
-        winner_code = await pick_random_winner()
+    winner_code = await pick_random_winner()
 
     if not winner_code:
         await update.message.reply_text("Нет участников для розыгрыша.")
@@ -171,18 +317,11 @@ async def export_participants(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("Команда недоступна.")
         return
 
-    rows = await fetch_all_participants()
-    if not rows:
+    buf = await export_participants_csv()
+    if buf is None:
         await update.message.reply_text("В базе пока нет участников.")
         return
 
-    buf = io.StringIO()
-    writer = csv.writer(buf)
-    writer.writerow(["id", "email"])
-    for row in rows:
-        writer.writerow(row)
-    buf.seek(0)
-
     await update.message.reply_document(
         document=InputFile(buf, filename="participants.csv"),
         caption="Список участников",
@@ -191,11 +330,30 @@ async def export_participants(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 # ---------- webhook server (aiohttp) ----------
 
+# держим ссылки на фоновые задачи, чтобы их не собрал GC
+_background_tasks: set[asyncio.Task] = set()
+# слот занят, пока апдейт не обработан до конца
+_update_slots = asyncio.Semaphore(MAX_CONCURRENT_UPDATES)
+
+
+async def _process_raw_update(app, raw: bytes):
+    try:
+        update = Update.de_json(orjson.loads(raw), app.bot)
+    except Exception:
+        logger.exception("Failed to parse webhook update")
+        return
+    await app.process_update(update)
+
+
 async def telegram_webhook(request: web.Request):
     app = request.app["bot_app"]
-    data = await request.json()
-    update = Update.de_json(data, app.bot)
-    await app.update_queue.put(update)
+    raw = await request.read()
+    # под нагрузкой ждём свободный слот и тем самым притормаживаем Telegram
+    await _update_slots.acquire()
+    task = asyncio.create_task(_process_raw_update(app, raw))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(lambda _: _update_slots.release())
     return web.Response(text="ok")
 
 
@@ -213,8 +371,9 @@ async def healthcheck(request: web.Request):
 
 
 async def main():
-    # создаём таблицу, если её нет
-    await asyncio.to_thread(init_db)
+    # создаём пул соединений и таблицу, если её нет
+    await init_db()
+    insert_worker = asyncio.create_task(_insert_worker())
 
     application = (
         ApplicationBuilder()
@@ -234,7 +393,8 @@ async def main():
     web_app.router.add_get("/set_webhook", set_webhook_handler)
     web_app.router.add_get("/", healthcheck)
 
-    runner = web.AppRunner(web_app)
+    # access log не нужен: почти весь трафик — вебхуки Telegram
+    runner = web.AppRunner(web_app, access_log=None)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", int(os.getenv("PORT", "10000")))
 
@@ -247,9 +407,17 @@ async def main():
     try:
         await asyncio.Event().wait()
     finally:
+        # сначала перестаём принимать вебхуки, затем дожидаемся обработки
+        # уже подтверждённых апдейтов, пока приложение ещё работает
+        await runner.cleanup()
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
         await application.stop()
         await application.shutdown()
-        await runner.cleanup()
+        insert_worker.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await insert_worker
+        _fail_pending_inserts(RuntimeError("Service is shutting down"))
+        await pool.close()
 
 
 if __name__ == "__main__":